@@ -3,6 +3,7 @@
 # Author: Kartikeya Rokde
 ##############################################################
 
+import io
 import os
 import sys
 import ast
@@ -10,46 +11,217 @@ import math
 import numpy
 import json
 import logging
-import subprocess
+import pkgutil
+import multiprocessing
 import matplotlib
 matplotlib.use('Agg')
 
-import matplotlib.pylab as p
+import matplotlib.image
 from matplotlib import pyplot as plt
-from pkg_resources import resource_string, resource_listdir, resource_stream
+from matplotlib.backends.backend_pdf import PdfPages
 
 #------------------------------------------------------------------------------
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# ECG grid image as uint8 RGB, decoded on first render and drawn as background of every page
+_grid_image = None
+
+# # Page layout constants
+
+# Graph plotting resolution
+_RESOLUTION = 96 # ppi (pixels per inch), A4 page of 793x1122 px
+
+# Resolution of grid image embedded in PDF
+_PDF_RESOLUTION = 300 # ppi
+
+# Page size
+_PAGE_SIZE = (8.267, 11.692) # inches, A4
+
+# Grid position on page as (left, bottom, width, height) fractions of page
+_GRID_POSITION = (0.024, 0.0671, 0.9525, 0.6735) # 20x20 cm
+
+# Limits of graph on Y axis
+_Y_LIMIT = (-2.5, 2.5) # cm
+
+
+def _new_page(display_information, strips_per_page):
+    """
+        Method to form page figure with ECG grid, meta data and footer
+        @param display_information: dict of meta data printed on top of page
+        @param strips_per_page: number of strips on page
+        @return: figure and list of strip axes, top strip first
+    """
+    global _grid_image
+    
+    # Decoding ECG grid image once per process
+    if _grid_image is None:
+        grid_png = pkgutil.get_data('pyECG_graph.resources', 'ecg_grid.png')
+        grid_image = matplotlib.image.imread(io.BytesIO(grid_png), format='png')
+        _grid_image = (grid_image * 255).astype(numpy.uint8)
+    
+    # Forming A4 page figure, reused for every page
+    fig = plt.figure(figsize=_PAGE_SIZE, dpi=_RESOLUTION)
+    
+    # Drawing ECG grid as page background
+    grid_ax = fig.add_axes(_GRID_POSITION)
+    grid_ax.imshow(_grid_image, extent=(0, 1, 0, 1), aspect='auto')
+    grid_ax.set_axis_off()
+    
+    # Adding one axes per strip over the grid, top strip first
+    grid_left, grid_bottom, grid_width, grid_height = _GRID_POSITION
+    strip_height = grid_height / strips_per_page
+    axes = [fig.add_axes((grid_left, grid_bottom + (strips_per_page - num - 1) * strip_height,
+                          grid_width, strip_height))
+            for num in range(strips_per_page)]
+    
+    # # Writing meta data display info on top of page
+    meta_text = '\n'.join(str(info_key) + ': ' + str(info_value)
+                           for info_key, info_value in display_information.items())
+    fig.text(0.034, 0.988, meta_text, fontsize=10, verticalalignment='top', linespacing=1.5)
+    
+    fig.text(0.034, 0.036, 'ECG Graph generated by https://github.com/KartikeyaRokde/pyECG_graph',
+             fontsize=10, color='#1A1A1A')
+    
+    return fig, axes
+
+
+def _min_max_decimate(page, strip_time_axis, samples_per_pixel):
+    """
+        Method to reduce strips to min and max of samples drawn in each pixel column,
+        keeping the peaks which plain stride selection would drop
+        @param page: 2D array of page, one strip per row
+        @param strip_time_axis: time axis of one strip starting at 0
+        @param samples_per_pixel: number of samples drawn in one pixel column
+        @return: time axis and page with 2 samples per pixel column
+    """
+    strips_num = page.shape[0]
+    # Column start indices, the last column holds remaining samples of strip
+    column_starts = numpy.arange(0, page.shape[1], samples_per_pixel)
+    column_ends = numpy.append(column_starts[1:], page.shape[1]) - 1
+    
+    # fmin/fmax skip NaN samples, a column is NaN only when all its samples are
+    decimated_page = numpy.empty((strips_num, len(column_starts), 2), dtype=page.dtype)
+    decimated_page[..., 0] = numpy.fmin.reduceat(page, column_starts, axis=1)
+    decimated_page[..., 1] = numpy.fmax.reduceat(page, column_starts, axis=1)
+    
+    # Spanning each column from its first to its last sample time
+    decimated_time_axis = numpy.empty((len(column_starts), 2), dtype=strip_time_axis.dtype)
+    decimated_time_axis[:, 0] = strip_time_axis[column_starts]
+    decimated_time_axis[:, 1] = strip_time_axis[column_ends]
+    return decimated_time_axis.ravel(), decimated_page.reshape(strips_num, -1)
+
+
+def _plot_page(axes, page, strip_time_axis, strip_duration):
+    """
+        Method to plot strips of a page on strip axes
+        @param axes: list of strip axes of page figure
+        @param page: 2D array of page, one strip per row
+        @param strip_time_axis: time axis of one strip starting at 0
+        @param strip_duration: time of one strip in seconds
+    """
+    # Clearing strips of previous page
+    for ax in axes:
+        ax.clear()
+        # Switching off drawing of axis lines
+        ax.set_axis_off()
+    
+    # drawing stuff follows
+    start_time = 0
+    end_time = 0
+    
+    # # Plotting graph
+    # Initial 125 data are NaN in record for graph to draw after legend
+    for ax, data in zip(axes, page):
+
+        # Adding to endtime
+        end_time += strip_duration
+        
+        # Arranging data to plot grid
+        t = start_time + strip_time_axis
+        
+        # Setting x & y limits
+        ax.set_ylim(*_Y_LIMIT)
+        ax.set_xlim(start_time, end_time)
+        
+        # drawing signal
+        ax.plot(t, data, linewidth=0.4, color='k', alpha=1.0)
+        
+        # New start time
+        start_time = end_time
+
+
+def _render_pages(job):
+    """
+        Method to render pages to image files on one page figure, run in worker processes
+        @param job: tuple of (pages, file names, display information, strip time axis,
+                    strip duration, samples per pixel column)
+    """
+    pages, file_names, display_information, strip_time_axis, strip_duration, samples_per_pixel = job
+    fig, axes = _new_page(display_information, pages.shape[1])
+    try:
+        for page, file_name in zip(pages, file_names):
+            time_axis = strip_time_axis
+            # Reducing strips to image resolution when more than 2 samples fall in a pixel column
+            if samples_per_pixel > 2:
+                time_axis, page = _min_max_decimate(page, strip_time_axis, samples_per_pixel)
+            _plot_page(axes, page, time_axis, strip_duration)
+            fig.savefig(file_name, dpi=_RESOLUTION)
+            logger.debug("Page written successfully. File = %s" % file_name)
+    finally:
+        plt.close(fig)
+
 
 def generate_ecg_graph(ecg_data, output_dir, output_file_name='graph', export_to='pdf', meta={}, *args, **kwargs):
     """
     Generates ECG graph for given data
     @param ecg_data: Required. ECG graph data.
-                        - Data should be a valid list OR a valid file path.
+                        - Data should be a valid list, numpy array OR a valid file path.
+                        - File can be a JSON / python list or a numpy .npy file.
     @param output_dir: Required. Valid directory path where generated output files are to be placed.
     @param export_to: Exports graph to provided format. Supported export file types are 'pdf', 'jpg', 'png'. 
                         Default is 'pdf'.
+                        - Multiple pages are written to a single PDF, or to one image per page.
     @param meta: Optional dictionary containing any information. It will be printed on top of the output file.
     @param kwargs: 
             record_frequency: Default=250.0. Specifies the frequency on which ECG data was taken. 
                               Assuming default frequency 250 Hz.
+            processes: Default=1. Number of worker processes rendering pages of 'jpg' / 'png' exports.
+                       Default renders all pages in the calling process. Scripts passing processes > 1
+                       must call generate_ecg_graph under `if __name__ == '__main__':`, as workers
+                       re-import the main module on platforms starting processes by spawn (macOS, Windows).
     """
     
     def get_ecg_data(record_path):
         """
             Method to get ecg data from file
             @param record_path: Path of ECG record
-            @return: list of ECG records
+            @return: list or numpy array of ECG records
         """
-        logger.debug("Reading ECG data from data file = %s" % record_path)
         # Check if record path is provided
         if record_path is None or record_path == "":
             sys.exit("ECG GRAPH GENERATOR: Record path not provided")
             return None
         
+        # Accepting str, bytes and path-like objects only
+        try:
+            record_path = os.fsdecode(record_path)
+        except TypeError:
+            sys.exit("ECG GRAPH GENERATOR: Record path is invalid. Record path: %s" % (record_path,))
+            return None
+        
+        logger.debug("Reading ECG data from data file = %s" % record_path)
+        
+        # Reading numpy record directly as array
+        if record_path.lower().endswith('.npy'):
+            try:
+                graph_array = numpy.load(record_path)
+            except:
+                sys.exit("ECG GRAPH GENERATOR: Record is not a valid numpy array. Record path: %s" % record_path)
+                return None
+            return graph_array
+        
         # Reading graph data from record
         try:    
             with open(record_path, 'r') as graph_data_file:
@@ -62,7 +234,11 @@ def generate_ecg_graph(ecg_data, output_dir, output_file_name='graph', export_to
         
         # Converting record data to list
         try:
-            graph_list = ast.literal_eval(graph_data)
+            try:
+                graph_list = json.loads(graph_data)
+            except ValueError:
+                # Falling back to python literal records
+                graph_list = ast.literal_eval(graph_data)
             if not isinstance(graph_list, list):
                 raise Exception
         except:
@@ -72,43 +248,6 @@ def generate_ecg_graph(ecg_data, output_dir, output_file_name='graph', export_to
         # Returning graph list
         return graph_list
 
-    def chunks(l, n):
-        """
-            Method to chunk list to list of lists
-            @param l: list to be chunk
-            @param n: number to which list needs to be chunk
-            @return: generator object of list of lists
-        """
-        for i in xrange(0, len(l), n):
-            yield l[i:i+n]
-            
-    def padwithnone(vector, pad_width, iaxis, kwargs):
-        """
-            Method to pad numpy array with None
-        """
-        if pad_width != (0,0):
-            vector[:pad_width[0]] = None    
-            vector[-pad_width[1]:] = None
-        return vector
-    
-    def prepadwithnone(vector, pad_width, iaxis, kwargs):
-        """
-            Method to prepad numpy array with None
-        """
-        if pad_width != (0,0):
-            vector[pad_width[0]:pad_width[1]] = None
-        
-        return vector[ 0 : (( len(vector )) - ( 2 * pad_width[1] )) ]
-    
-    def partition(lst, n):
-        """
-            Method to partition list to lists
-            @param lst: list to be partitioned
-            @param n: number of lists for the list to be partitioned to
-        """
-        division = len(lst) / float(n)
-        return [ lst[int(round(division * i)): int(round(division * (i + 1)))] for i in xrange(n) ]
-    
     logger.debug("Started executing pyECG.generate_ecg_graph()")
     
     # # Constants
@@ -122,18 +261,6 @@ def generate_ecg_graph(ecg_data, output_dir, output_file_name='graph', export_to
     # Plot scale
     plot_scale = "25mm/s, 10mm/mV"
     
-    # Graph plotting resolution
-    resolution = 72 # ppi (pixels per inch)
-    
-    # No. of pixels in 1 cm for current resolution
-    cm = 28.35 # pixels
-    
-    # Image size
-    image_size = (int(20*cm), int(20*cm)) # 567x567 px
-    
-    # Limits of graph on Y axis
-    y_limit = (-2.5, 2.5) # cm
-    
     # One page strips limit
     strips_per_page = 4
     
@@ -145,157 +272,67 @@ def generate_ecg_graph(ecg_data, output_dir, output_file_name='graph', export_to
     # Getting data from kwargs
     record_frequency = kwargs.get('record_frequency', default_frequency)
     logger.debug("Record frequency = %s" % record_frequency)
+    processes = kwargs.get('processes', 1)
     
-    # Check if ecg_data is a valid list, else getting data from file
-    if isinstance(ecg_data, list):
+    # Check if ecg_data is a valid list or array, else getting data from file
+    if isinstance(ecg_data, (list, numpy.ndarray)):
         record = ecg_data
     else:
         record = get_ecg_data(ecg_data)
     
-    # Checking if data is a valid list
-    if not isinstance(record, list):
-        logger.error("ECG record provided must be a valid list")
+    # Checking if data is a valid list or array
+    if not isinstance(record, (list, numpy.ndarray)):
+        logger.error("ECG record provided must be a valid list or numpy array")
+        return None
+    
+    # Converting record to float array, none values become NaN
+    try:
+        record = numpy.asarray(record, dtype=numpy.float32)
+    except (TypeError, ValueError):
+        logger.error("ECG record provided must contain only numeric values")
         return None
     
-    # Prepending initial 125 records with none for ECG legend
-    for _ in range(0, 125):
-        record.insert(0, None)
+    # Checking if record is one dimensional
+    if record.ndim != 1:
+        logger.error("ECG record provided must be one dimensional, got %s dimensions" % record.ndim)
+        return None
     
-    # Calculating number of records
-    signals_num = len(record)
+    # Calculating number of records, including initial 125 records for ECG legend
+    signals_num = len(record) + 125
     logger.debug("ECG Signals count = %s" % signals_num)
     
     # Calculating no. of records needed in a strip
-    one_strip_length = one_strip_time * record_frequency
+    one_strip_length = int(one_strip_time * record_frequency)
     
     # No. of strips need to plot    
     no_of_strips = float(math.ceil(float(signals_num) / float(one_strip_length)))
-    
+
     extra_strips_needed = 0
     # Calculating difference for number of strips on page
     if no_of_strips%strips_per_page:
         extra_strips_needed = strips_per_page - (no_of_strips%strips_per_page)
-    
-        # Appending none in the extra strips
-        for a in range(int(extra_strips_needed)):
-            for _ in range(0, int(one_strip_length)):
-                record.append(None)
-        
-    record_list = partition(record, int((no_of_strips+extra_strips_needed)/strips_per_page))
+
+    # Allocating all strips of all pages at once
+    # Initial 125 records for ECG legend, last strip and extra strips are NaN
+    padded_record = numpy.empty(int(no_of_strips + extra_strips_needed) * one_strip_length, dtype=numpy.float32)
+    padded_record[:125] = numpy.nan
+    padded_record[125:signals_num] = record
+    padded_record[signals_num:] = numpy.nan
+
+    # Splitting record in pages of strips, each strip is a row view of record
+    record_list = padded_record.reshape(-1, strips_per_page, one_strip_length)
     
     record_time = int(round((signals_num - 125) / record_frequency))
     logger.debug("ECG record time = %s seconds for Record Frequency %s" % (record_time, record_frequency))
     
-    if no_of_strips < strips_per_page:
-        no_of_strips += extra_strips_needed
-    
     # Output files dict
     output_files = {}
     
-    for seq, rec in enumerate(record_list):
-    
-        # # Graph plotting setup
-        plt.axis('off')
-        
-        # Forming figure
-        # figsize 10.13, 9.8 generates a perfect 567x567 pixels svg
-        fig = plt.figure(figsize=(10.13,9.8), dpi=resolution)
-        fig.subplots_adjust(hspace=0)
-        
-        # drawing stuff follows
-        ylims = y_limit
-        start_time = 0
-        end_time = 0
-        
-        # Split record in chunks
-        plot_record_list = chunks(rec, int(one_strip_length))
-        
-        
-        # # Plotting graph
-        for num, plot in enumerate(plot_record_list):
-            
-            # read data for specified signal
-            # equal to record.read(i, ...
-            numpy_plot = numpy.array(plot)
-            
-            if num == 0:
-                # Pre-padding initial 125 data with none for graph to draw after legend 
-                data = numpy.pad(numpy_plot, (0,125), prepadwithnone)
-                data = data [ 0 : (len(data) - 125) ]
-            else:
-                # Padding data at the end if length is less than one strip length
-                data = numpy.pad(numpy_plot, (0,one_strip_length-len(numpy_plot)), padwithnone)
-            
-            # Adding to endtime
-            end_time += len(data) / record_frequency
-            
-            # Arranging data to plot grid
-            nrange = [start_time + nu*(1/record_frequency) for nu in range(len(data))\
-                      if (start_time + nu*(1/record_frequency)) <= end_time] 
-            t = numpy.array(nrange)
-            
-            # Adding subplot to the current figure
-            ax = p.subplot(no_of_strips, 1, num+1)
-            
-            # Switching off drawing of axis lines
-            ax.axis('off')
-            
-            # Setting x & y limits
-            p.ylim(*ylims)
-            p.xlim(start_time, end_time)
-            
-            # drawing signal
-            try:
-                ax.plot(t, data, linewidth=0.4, color='k', alpha=1.0)
-            except ValueError as e:
-                logger.error("Error in plotting ECG data. Error: %s" % e)
-                return None
-            
-            # New start time
-            start_time = end_time
-            
-            # Removing labels
-            p.setp(ax.get_xticklabels(), visible=False)
-            p.setp(ax.get_yticklabels(), visible=False)
-        
-        
-        file_name = output_dir
-        file_name += str(seq+1) + '.svg'
-        
-        # Saving the plotted graph
-        fig.savefig(file_name,
-                    dpi=resolution,
-                    transparent=True, bbox_inches='tight', pad_inches=0.01)        
-        
-        # # Merging ecg graph and ecg grid
-        
-        # Opening graph svg file plotted above by matplotlib
-        graph_svg_file = open(file_name, 'rw+')
-        graph_svg = graph_svg_file.read()
-        
-        # Opening grid svg file template
-        grid_svg = resource_string('pyECG_graph.resources', 'ecg_grid.svg')
-        
-        # # Adding graph data to grid data
-        
-        # Deleting data other than graph
-        graph_data = graph_svg[462:]
-        graph_data = graph_data[:-7]
-        grid_data = grid_svg.replace('$$ecg_graph$$',graph_data)
-        
-        # Truncating file data
-        graph_svg_file.truncate()
-        graph_svg_file.close()
-        
-        # Merging graph data with grid data
-        with open(file_name, 'w') as graph_svg_file:
-            graph_svg_file.write(str(grid_data))
-        
-        # Graph plotted successfully
-        output_files [seq+1] = str(output_dir + output_file_name + '.' + export_to)
-        logger.debug("SVG file written successfully. File = %s" % file_name)
+    # Time axis of one strip, shifted by start time of each strip
+    strip_time_axis = numpy.arange(one_strip_length, dtype=numpy.float32) / record_frequency
+    strip_duration = one_strip_length / float(record_frequency)
     
-    # Writing meta data file
+    # Forming meta data
     display_information = {'Record frequency' : str(record_frequency) + ' Hz',
                            'Scale' : plot_scale,
                            'No. of signals' : signals_num, 
@@ -306,49 +343,55 @@ def generate_ecg_graph(ecg_data, output_dir, output_file_name='graph', export_to
                      record_time=record_time,
                      output_files=output_files,
                      display_information=display_information)
-
-    # Writing graph to PDF
-    page_2_template = resource_string('pyECG_graph.resources', 'ecg_graph_template.svg')
-    # Writing ECG meta data
-    page_2_template = page_2_template.replace('$$recorded_time$$', str(record_time))
-    page_2_template = page_2_template.replace('$$duration$$', meta_data['display_information']['Duration'])
-    page_2_template = page_2_template.replace('$$graph_image$$', str(file_name))
-
-    # # Writing meta data display info
     meta_data['display_information'].update(meta)
-    # Forming xml syntax
-    meta_xml = ''
-    y = 0
-    for info_key, info_value in meta_data['display_information'].iteritems():
-        meta_xml += '<tspan x="0" y="' + str(y) + '" font-size="10">' + str(info_key) + ': ' + str(info_value) + '</tspan>'
-        y += 16
-        
-    page_2_template = page_2_template.replace('$$meta$$', str(meta_xml))
     
-    # Converting svg to pdf using phantomjs
-    # Saving to temp svg
-    graph_page_svg_path = output_dir + 'graph_page.svg'
-    with open(graph_page_svg_path,'w') as fout_svg2:
-        fout_svg2.write(page_2_template)
-
-    # Replacing phantom pdf js file placeholders to temp2 js
-    temp_phantom_js_path2 = output_dir + '/temp2.js'
-
-    with open(temp_phantom_js_path2, 'w') as temp_phantom_js2:
-        #phantom_template = f.read()
-        phantom_template = resource_string('pyECG_graph.resources', 'phantompdf.js')
-        write_data = phantom_template.replace('$$file_path$$',graph_page_svg_path)
-        write_data = write_data.replace('$$output_dir$$', (output_dir + output_file_name + '.' + export_to) )
-        temp_phantom_js2.write(write_data)
-
-    # subprocess call for converting svg to pdf using phantom js
-    subprocess.call(['phantomjs', temp_phantom_js_path2])
-
-    # Removing temporary files
-    os.remove(file_name)
-    os.remove(graph_page_svg_path)
-    os.remove(temp_phantom_js_path2)
+    output_file = output_dir + output_file_name + '.' + export_to
+    
+    # All pages are written to a single PDF, else one image per page when there are more pages
+    if export_to == 'pdf' or len(record_list) == 1:
+        file_names = [output_file] * len(record_list)
+    else:
+        file_names = [output_dir + output_file_name + '_' + str(seq+1) + '.' + export_to
+                      for seq in range(len(record_list))]
+    
+    try:
+        if export_to == 'pdf':
+            fig, axes = _new_page(meta_data['display_information'], strips_per_page)
+            pdf = PdfPages(output_file)
+            try:
+                for page in record_list:
+                    _plot_page(axes, page, strip_time_axis, strip_duration)
+                    pdf.savefig(fig, dpi=_PDF_RESOLUTION)
+            finally:
+                pdf.close()
+                plt.close(fig)
+        else:
+            # Samples drawn in one pixel column of a strip
+            strip_pixels = int(_GRID_POSITION[2] * _PAGE_SIZE[0] * _RESOLUTION)
+            samples_per_pixel = one_strip_length // strip_pixels
+            
+            # Rendering pages in parallel, each worker renders every n-th page
+            processes = max(1, min(processes, len(record_list)))
+            jobs = [(record_list[w::processes], file_names[w::processes],
+                     meta_data['display_information'], strip_time_axis, strip_duration, samples_per_pixel)
+                    for w in range(processes)]
+            if processes == 1:
+                _render_pages(jobs[0])
+            else:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    pool.map(_render_pages, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+    except ValueError as e:
+        logger.error("Error in plotting ECG data. Error: %s" % e)
+        return None
+    
+    # Graph plotted successfully
+    for seq, file_name in enumerate(file_names):
+        output_files [seq+1] = str(file_name)
     
     # Returning meta data
-    logger.info("ECG graph plotted successfully to %s" % (output_dir + output_file_name + '.' + export_to))
+    logger.info("ECG graph plotted successfully to %s" % output_file)
     return meta_data
@@ -8,5 +8,5 @@ setup(name='pyECG_graph',
       author='Kartikeya Rokde',
       author_email='kartik.a.rokde@gmail.com',
       license='MIT',
-      package_data={'': ['*.svg', '*.js']},
+      package_data={'': ['*.png']},
       zip_safe=False)